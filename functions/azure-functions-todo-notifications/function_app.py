@@ -1,9 +1,6 @@
-import logging
-
 import azure.functions as func  # type: ignore
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Logging is configured by the Azure Functions host
 
 app = func.FunctionApp()
 
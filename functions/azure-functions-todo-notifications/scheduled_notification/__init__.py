@@ -1,47 +1,70 @@
+import asyncio
 import logging
+import time
 from datetime import datetime, timezone
 
 import azure.functions as func
-from shared.email_service import send_email
-from shared.todo_service import TodoService
+from shared.email_service import get_async_session, send_email_async
+from shared.notifications import compose_reminder
+from shared.todo_service import (
+    ACTIONABLE_LOOKAHEAD,
+    DEFAULT_PARTITION_KEY,
+    get_todo_service,
+)
 
+# Upper bound on notifications in flight at once, to stay within Mailgun limits
+MAX_CONCURRENT_NOTIFICATIONS = 20
 
-def main(mytimer: func.TimerRequest) -> None:
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+async def main(mytimer: func.TimerRequest) -> None:
     """
     Timer-triggered Azure Function that runs every 30 minutes
     to send todo notifications based on due dates and completion status.
     """
-    utc_timestamp = (
-        datetime.now(tz=timezone.utc).replace(tzinfo=timezone.utc).isoformat()
-    )
+    # All scheduling decisions in this run are made against a single timestamp
+    now_epoch = int(time.time())
+    utc_timestamp = datetime.fromtimestamp(now_epoch, tz=timezone.utc).isoformat()
 
     if mytimer.past_due:
         logging.info("The timer is past due!")
 
-    logging.info(f"Todo notification function executed at {utc_timestamp}")
+    logging.info("Todo notification function executed at %s", utc_timestamp)
 
     try:
-        # Initialize the TodoService
-        todo_service = TodoService()
-        current_time = datetime.now(timezone.utc)
+        # Reuse the TodoService, and its Cosmos client, from earlier runs
+        todo_service = get_todo_service()
+
+        # Only fetch todos that can trigger a notification in this run; the
+        # query is blocking, so run it off the event loop
+        actionable_todos = await asyncio.to_thread(
+            todo_service.get_actionable_todos, now_epoch
+        )
 
-        # Process all active todos
-        all_todos = todo_service.get_all_todos()
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_NOTIFICATIONS)
+        session = get_async_session()
 
-        for todo in all_todos:
-            if todo.get("status") == "Completed":
-                continue
+        async def _handle(todo):
+            async with semaphore:
+                await process_todo_notifications(todo, now_epoch, todo_service, session)
 
-            process_todo_notifications(todo, current_time, todo_service)
+        # Send the notifications of all todos concurrently
+        tasks = [_handle(todo) for todo in actionable_todos]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Persist all reminder flags in as few round trips as possible
+        todo_service.flush_batches()
 
         logging.info("Todo notification processing completed successfully")
 
     except Exception as e:
-        logging.error(f"Error in todo notification function: {str(e)}")
+        logging.error("Error in todo notification function: %s", e)
         raise
 
 
-def process_todo_notifications(todo, current_time, todo_service):
+async def process_todo_notifications(todo, now_epoch, todo_service, session):
     """Process notification logic for a single todo item"""
     try:
         due_date_epoch = todo.get("due_date")
@@ -54,147 +77,66 @@ def process_todo_notifications(todo, current_time, todo_service):
             if isinstance(due_date_epoch, str):
                 due_date_epoch = float(due_date_epoch)
 
-            # Convert epoch to UTC datetime
-            due_date = datetime.fromtimestamp(due_date_epoch, tz=timezone.utc)
+            # Seconds until due, negative once the item is overdue
+            time_diff = due_date_epoch - now_epoch
         except (ValueError, TypeError) as e:
             logging.error(
-                f'Invalid due_date format for todo {todo.get("id", "unknown")}: {due_date_epoch}'
+                "Invalid due_date format for todo %s: %s",
+                todo.get("id", "unknown"),
+                due_date_epoch,
             )
             return
 
-        time_diff = due_date - current_time
-        cast_floats_fields_to_int(todo)
-
-        # Check if item is overdue (up to 1 hour)
-        if (
-            time_diff.total_seconds() < 0 and abs(time_diff.total_seconds()) <= 3600
-        ):  # 1 hour = 3600 seconds
-            send_overdue_notification(todo, due_date)
-
-        # Check for 24-hour reminder (23.5 to 24.5 hours before due)
-        elif 24 * 3600 <= time_diff.total_seconds() < 25 * 3600:
-            if not has_received_24h_reminder(todo):
-                send_24h_reminder(todo, due_date)
-                mark_24h_reminder_sent(todo, todo_service)
-
-        # Check for final reminder (0.5 to 23.5 hours before due)
-        elif 0.5 * 3600 <= time_diff.total_seconds() <= 23.5 * 3600:
-            if not has_received_final_reminder(todo):
-                send_final_reminder(todo, due_date)
-                mark_final_reminder_sent(todo, todo_service)
-
-        # Daily reminders for items that are overdue by more than 1 hour
-        elif time_diff.total_seconds() < -3600:  # More than 1 hour overdue
-            if should_send_daily_reminder(todo, current_time):
-                send_daily_overdue_reminder(todo, due_date)
-                update_last_notification_time(todo, current_time, todo_service)
-
-    except Exception as e:
-        logging.error(f'Error processing todo {todo.get("id", "unknown")}: {str(e)}')
+        # Skip todos not yet in any notification window before doing any work
+        if time_diff >= ACTIONABLE_LOOKAHEAD:
+            return
 
+        kind = _classify(time_diff, todo, now_epoch)
+        if kind:
+            await _send(kind, todo, now_epoch, todo_service, session)
 
-def cast_floats_fields_to_int(todo):
-    """Convert float fields in todo to int for consistency"""
-    try:
-        for key in ["due_date", "created_at", "updated_at", "last_notification_time"]:
-            if key in todo and isinstance(todo[key], float):
-                todo[key] = int(todo[key])
     except Exception as e:
-        logging.error(f"Error casting float fields: {str(e)}")
+        logging.error("Error processing todo %s: %s", todo.get("id", "unknown"), e)
 
 
-def send_overdue_notification(todo, due_date):
-    """Send notification for items that are overdue by at most 1 hour"""
-    try:
-        email = todo.get("email")
-        subject = f"Todo Item Overdue: {todo.get('title', 'Untitled')}"
-        body = f"""
-        Hello {todo.get('assignee')}\n\n,
-        Your todo item "{todo.get('title', 'Untitled')}" is now overdue.
-        
-        Due Date: {due_date.strftime('%Y-%m-%d %H:%M:%S UTC')}
-        Description: {todo.get('description', 'No description')}
-        
-        Please complete this task as soon as possible.
-        """
-
-        send_email(email, subject, body)
-        logging.info(f'Sent overdue notification to {email} for todo {todo.get("id")}')
+def _classify(time_diff, todo, now_epoch):
+    """Return the kind of notification a todo is due for, or None"""
+    # Overdue by at most 1 hour
+    if -HOUR <= time_diff < 0:
+        return "overdue"
 
-    except Exception as e:
-        logging.error(f"Failed to send overdue notification: {str(e)}")
+    # 24 to 25 hours before due
+    if DAY <= time_diff < DAY + HOUR:
+        return None if has_received_24h_reminder(todo) else "24h"
 
+    # 0.5 to 23.5 hours before due
+    if HOUR // 2 <= time_diff <= DAY - HOUR // 2:
+        return None if has_received_final_reminder(todo) else "final"
 
-def send_24h_reminder(todo, due_date):
-    """Send 24-hour advance reminder"""
-    try:
-        email = todo.get("email")
-        name = todo.get("assignee")
-        subject = f"Reminder: Todo Due in 24 Hours - {todo.get('title', 'Untitled')}"
-        body = f"""
-        Hello {name},\n\n
-        This is a reminder that your todo item is due in approximately 24 hours.
-        
-        Title: {todo.get('title', 'Untitled')}
-        Due Date: {due_date.strftime('%Y-%m-%d %H:%M:%S UTC')}
-        Description: {todo.get('description', 'No description')}
-        
-        Please plan to complete this task soon.
-        """
-
-        send_email(email, subject, body)
-        logging.info(f'Sent 24h reminder to {email} for todo {todo.get("id")}')
+    # Overdue by more than 1 hour, repeated daily
+    if time_diff < -HOUR:
+        if should_send_daily_reminder(todo, now_epoch):
+            return "daily"
+        return None
 
-    except Exception as e:
-        logging.error(f"Failed to send 24h reminder: {str(e)}")
+    return None
 
 
-def send_final_reminder(todo, due_date):
-    """Send final reminder when less than 24 hours remain"""
+async def _send(kind, todo, now_epoch, todo_service, session):
+    """Render a notification for a todo, email it, and record that it was sent"""
+    label, post_hook = NOTIFICATIONS[kind]
     try:
         email = todo.get("email")
-        subject = f"Final Reminder: Todo Due Soon - {todo.get('title', 'Untitled')}"
-        body = f"""
-        Hello {todo.get('assignee')},\n\n
-        This is your final reminder - your todo item is due very soon!
-        
-        Title: {todo.get('title', 'Untitled')}
-        Due Date: {due_date.strftime('%Y-%m-%d %H:%M:%S UTC')}
-        Description: {todo.get('description', 'No description')}
-        
-        Please complete this task immediately.
-        """
-
-        send_email(email, subject, body)
-        logging.info(f'Sent final reminder to {email} for todo {todo.get("id")}')
+        subject, body = compose_reminder(kind, todo)
 
-    except Exception as e:
-        logging.error(f"Failed to send final reminder: {str(e)}")
-
-
-def send_daily_overdue_reminder(todo, due_date):
-    """Send daily reminder for overdue items"""
-    try:
-        email = todo.get("email")
-        subject = f"Daily Reminder: Overdue Todo - {todo.get('title', 'Untitled')}"
-        body = f"""
-        Hello {todo.get('assignee')},\n\n
-        Daily reminder: Your todo item is still overdue and needs attention.
-        
-        Title: {todo.get('title', 'Untitled')}
-        Due Date: {due_date.strftime('%Y-%m-%d %H:%M:%S UTC')}
-        Description: {todo.get('description', 'No description')}
-        
-        Please complete this overdue task.
-        """
-
-        send_email(email, subject, body)
-        logging.info(
-            f'Sent daily overdue reminder to {email} for todo {todo.get("id")}'
-        )
+        await send_email_async(session, email, subject, body)
+        logging.info("Sent %s to %s for todo %s", label, email, todo.get("id"))
 
     except Exception as e:
-        logging.error(f"Failed to send daily overdue reminder: {str(e)}")
+        logging.error("Failed to send %s: %s", label, e)
+
+    if post_hook:
+        post_hook(todo, now_epoch, todo_service)
 
 
 def has_received_24h_reminder(todo):
@@ -207,7 +149,7 @@ def has_received_final_reminder(todo):
     return todo.get("final_reminder_sent", False)
 
 
-def should_send_daily_reminder(todo, current_time):
+def should_send_daily_reminder(todo, now_epoch):
     """Check if daily reminder should be sent (every 24 hours)"""
     last_notification_epoch = todo.get("last_notification_time")
     if not last_notification_epoch:
@@ -218,52 +160,68 @@ def should_send_daily_reminder(todo, current_time):
         if isinstance(last_notification_epoch, str):
             last_notification_epoch = float(last_notification_epoch)
 
-        last_notification_time = datetime.fromtimestamp(
-            last_notification_epoch, tz=timezone.utc
-        )
-        time_since_last = current_time - last_notification_time
-
         # Send daily reminder if more than 24 hours since last notification
-        return time_since_last.total_seconds() >= 24 * 3600
+        return now_epoch - last_notification_epoch >= DAY
 
     except (ValueError, TypeError) as e:
         logging.error(
-            f"Invalid last_notification_time format: {last_notification_epoch}"
+            "Invalid last_notification_time format: %s", last_notification_epoch
         )
         return True  # Default to sending if we can't parse the timestamp
 
 
-def mark_24h_reminder_sent(todo, todo_service):
+def get_partition_key(todo):
+    """Return the Cosmos DB partition key value of a todo item"""
+    return todo.get("partition_key", DEFAULT_PARTITION_KEY)
+
+
+def mark_24h_reminder_sent(todo, now_epoch, todo_service):
     """Mark that 24-hour reminder has been sent"""
     try:
-        # Update the todo item in Cosmos DB
+        # Queue the flag update, written to Cosmos DB at the end of the run
         todo["reminder_24h_sent"] = True
-        todo_service.upsert_item(todo)
-        logging.info(f'Marked 24h reminder as sent for todo {todo.get("id")}')
+        todo_service.queue_update(
+            todo["id"], get_partition_key(todo), {"reminder_24h_sent": True}
+        )
+        logging.info("Marked 24h reminder as sent for todo %s", todo.get("id"))
 
     except Exception as e:
-        logging.error(f"Failed to mark 24h reminder as sent: {str(e)}")
+        logging.error("Failed to mark 24h reminder as sent: %s", e)
 
 
-def mark_final_reminder_sent(todo, todo_service):
+def mark_final_reminder_sent(todo, now_epoch, todo_service):
     """Mark that final reminder has been sent"""
     try:
-        # Update the todo item in Cosmos DB
+        # Queue the flag update, written to Cosmos DB at the end of the run
         todo["final_reminder_sent"] = True
-        todo_service.upsert_item(todo)
-        logging.info(f'Marked final reminder as sent for todo {todo.get("id")}')
+        todo_service.queue_update(
+            todo["id"], get_partition_key(todo), {"final_reminder_sent": True}
+        )
+        logging.info("Marked final reminder as sent for todo %s", todo.get("id"))
 
     except Exception as e:
-        logging.error(f"Failed to mark final reminder as sent: {str(e)}")
+        logging.error("Failed to mark final reminder as sent: %s", e)
 
 
-def update_last_notification_time(todo, current_time, todo_service):
+def update_last_notification_time(todo, now_epoch, todo_service):
     """Update the last notification time for daily reminders"""
     try:
         # Store as epoch timestamp for consistency
-        todo["last_notification_time"] = int(current_time.timestamp())
-        todo_service.upsert_item(todo)
-        logging.info(f'Updated last notification time for todo {todo.get("id")}')
+        todo["last_notification_time"] = now_epoch
+        todo_service.queue_update(
+            todo["id"], get_partition_key(todo), {"last_notification_time": now_epoch}
+        )
+        logging.info("Updated last notification time for todo %s", todo.get("id"))
 
     except Exception as e:
-        logging.error(f"Failed to update last notification time: {str(e)}")
+        logging.error("Failed to update last notification time: %s", e)
+
+
+# Notification kind -> (log label, post-send hook)
+# Every hook takes (todo, now_epoch, todo_service)
+NOTIFICATIONS = {
+    "overdue": ("overdue notification", None),
+    "24h": ("24h reminder", mark_24h_reminder_sent),
+    "final": ("final reminder", mark_final_reminder_sent),
+    "daily": ("daily overdue reminder", update_last_notification_time),
+}
@@ -1,18 +1,46 @@
+import asyncio
+import json
 import os
 
+import aiohttp
 import requests
 
 EMAIL_SEND_API_KEY = os.environ.get("EMAIL_SEND_API_KEY")
 
 FROM_EMAIL = "family.leppanen.todos@familyleppanen.net"
 
+MAILGUN_MESSAGES_URL = "https://api.eu.mailgun.net/v3/familyleppanen.net/messages"
+
+# Mailgun accepts at most 1000 recipients per batch sending request
+MAILGUN_MAX_BATCH_RECIPIENTS = 1000
+
+# Created lazily, since an aiohttp session must be bound to the running loop
+_async_session = None
+
+
+def get_async_session():
+    """Return the shared aiohttp session, creating it on first use"""
+    global _async_session
+    if _async_session is None or _async_session.closed:
+        # Keep-alive connections to Mailgun are pooled and reused across
+        # invocations. Sends are not retried automatically, since Mailgun may
+        # already have accepted a POST that failed with a gateway error.
+        _async_session = aiohttp.ClientSession(
+            auth=aiohttp.BasicAuth("api", EMAIL_SEND_API_KEY),
+            connector=aiohttp.TCPConnector(
+                limit=20, limit_per_host=20, keepalive_timeout=60
+            ),
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
+    return _async_session
+
 
 def send_email(to_email, subject, content):
     res = requests.post(
-        "https://api.eu.mailgun.net/v3/familyleppanen.net/messages",
+        MAILGUN_MESSAGES_URL,
         auth=("api", EMAIL_SEND_API_KEY),
         data={
-            "from": "family.leppanen.todos@familyleppanen.net",
+            "from": FROM_EMAIL,
             "to": to_email,
             "subject": subject,
             "text": content,
@@ -30,6 +58,114 @@ def send_email(to_email, subject, content):
         }
 
 
+async def send_email_async(session, to_email, subject, content):
+    async with session.post(
+        MAILGUN_MESSAGES_URL,
+        data={
+            "from": FROM_EMAIL,
+            "to": to_email,
+            "subject": subject,
+            "text": content,
+        },
+    ) as res:
+        if res.status == 200:
+            return {
+                "status": "success",
+                "message": f"Email sent to {to_email} with subject '{subject}'",
+            }
+        else:
+            return {
+                "status": "error",
+                "message": f"Failed to send email to {to_email}. Status code: {res.status}, Response: {await res.text()}",
+            }
+
+
+class _RecipientVariables(dict):
+    """Format mapping that turns {field} into Mailgun's %recipient.field%"""
+
+    def __missing__(self, key):
+        return f"%recipient.{key}%"
+
+
+def _batch_chunks(messages):
+    """
+    Split message indexes into requests in which every recipient appears
+    once, with at most MAILGUN_MAX_BATCH_RECIPIENTS recipients each.
+    """
+    rounds = []
+    for index, (to_email, _) in enumerate(messages):
+        for batch in rounds:
+            if to_email not in batch:
+                break
+        else:
+            batch = {}
+            rounds.append(batch)
+        batch[to_email] = index
+
+    chunks = []
+    for batch in rounds:
+        indexes = list(batch.values())
+        for start in range(0, len(indexes), MAILGUN_MAX_BATCH_RECIPIENTS):
+            chunks.append(indexes[start : start + MAILGUN_MAX_BATCH_RECIPIENTS])
+    return chunks
+
+
+async def _post_batch(session, subject, text, recipient_variables):
+    data = [("from", FROM_EMAIL)]
+    data.extend(("to", to_email) for to_email in recipient_variables)
+    data.append(("recipient-variables", json.dumps(recipient_variables)))
+    data.append(("subject", subject))
+    data.append(("text", text))
+    async with session.post(MAILGUN_MESSAGES_URL, data=data) as res:
+        if res.status == 200:
+            return None
+        return f"Status code: {res.status}, Response: {await res.text()}"
+
+
+async def send_email_batch_async(session, subject_template, body_template, messages):
+    """
+    Send (to_email, variables) messages that share str.format templates using
+    Mailgun batch sending. The templates go out once per request, with each
+    recipient's variables filled in by Mailgun. Returns one status dict per
+    message, in order.
+    """
+    # Mailgun substitutes recipient variables for the {field} placeholders
+    subject = subject_template.format_map(_RecipientVariables())
+    text = body_template.format_map(_RecipientVariables())
+
+    chunks = _batch_chunks(messages)
+    # A recipient repeated in a batch needs another request; send them all
+    # concurrently, and let one failing request only affect its own messages
+    outcomes = await asyncio.gather(
+        *(
+            _post_batch(
+                session,
+                subject,
+                text,
+                {messages[i][0]: messages[i][1] for i in chunk},
+            )
+            for chunk in chunks
+        ),
+        return_exceptions=True,
+    )
+
+    results = [None] * len(messages)
+    for chunk, outcome in zip(chunks, outcomes):
+        for i in chunk:
+            to_email = messages[i][0]
+            if outcome is None:
+                results[i] = {
+                    "status": "success",
+                    "message": f"Email sent to {to_email} with subject '{subject_template.format_map(messages[i][1])}'",
+                }
+            else:
+                results[i] = {
+                    "status": "error",
+                    "message": f"Failed to send email to {to_email}. {outcome}",
+                }
+    return results
+
+
 def notify_assignee(assignee_email, todo_item):
     subject = f"Notification for Todo Item: {todo_item['title']}"
     content = f"Hello,\n\nThis is a reminder for your todo item:\n\nTitle: {todo_item['title']}\nDue Date: {todo_item['due_date']}\nStatus: {todo_item['status']}\n\nBest regards,\nYour Todo App"
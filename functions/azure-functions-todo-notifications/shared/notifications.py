@@ -0,0 +1,132 @@
+import logging
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, Mapping, Tuple
+
+EMAIL_DUE_DATE_FORMAT = "%A, %B %d, %Y at %I:%M %p UTC"
+REMINDER_DUE_DATE_FORMAT = "%Y-%m-%d %H:%M:%S UTC"
+
+NEW_TODO_SUBJECT = "New Todo Assigned: {title}"
+NEW_TODO_BODY = """Hello {assignee},
+
+A new todo item has been assigned to you:
+
+📋 Title: {title}
+📝 Description: {description}
+📅 Due Date: {due_date_str}
+
+Please review and plan accordingly.
+
+Best regards,
+Family Leppänen Todo System"""
+
+TODO_UPDATED_SUBJECT = "Todo Updated: {title}"
+TODO_UPDATED_BODY = """Hello {assignee},
+
+Your todo item has been updated:
+
+📋 Title: {title}
+📝 Description: {description}
+📅 Due Date: {due_date_str}
+✅ Status: {status}
+
+Please review the changes.
+
+Best regards,
+Family Leppänen Todo System"""
+
+OVERDUE_SUBJECT = "Todo Item Overdue: {title}"
+OVERDUE_BODY = """Hello {assignee},
+
+Your todo item "{title}" is now overdue.
+
+Due Date: {due_date_str}
+Description: {description}
+
+Please complete this task as soon as possible.
+"""
+
+REMINDER_24H_SUBJECT = "Reminder: Todo Due in 24 Hours - {title}"
+REMINDER_24H_BODY = """Hello {assignee},
+
+This is a reminder that your todo item is due in approximately 24 hours.
+
+Title: {title}
+Due Date: {due_date_str}
+Description: {description}
+
+Please plan to complete this task soon.
+"""
+
+FINAL_REMINDER_SUBJECT = "Final Reminder: Todo Due Soon - {title}"
+FINAL_REMINDER_BODY = """Hello {assignee},
+
+This is your final reminder - your todo item is due very soon!
+
+Title: {title}
+Due Date: {due_date_str}
+Description: {description}
+
+Please complete this task immediately.
+"""
+
+DAILY_OVERDUE_SUBJECT = "Daily Reminder: Overdue Todo - {title}"
+DAILY_OVERDUE_BODY = """Hello {assignee},
+
+Daily reminder: Your todo item is still overdue and needs attention.
+
+Title: {title}
+Due Date: {due_date_str}
+Description: {description}
+
+Please complete this overdue task.
+"""
+
+# Todo change kind -> (subject template, body template)
+CHANGE_NOTIFICATIONS = {
+    "new": (NEW_TODO_SUBJECT, NEW_TODO_BODY),
+    "updated": (TODO_UPDATED_SUBJECT, TODO_UPDATED_BODY),
+}
+
+# Scheduled reminder kind -> (subject template, body template)
+REMINDERS = {
+    "overdue": (OVERDUE_SUBJECT, OVERDUE_BODY),
+    "24h": (REMINDER_24H_SUBJECT, REMINDER_24H_BODY),
+    "final": (FINAL_REMINDER_SUBJECT, FINAL_REMINDER_BODY),
+    "daily": (DAILY_OVERDUE_SUBJECT, DAILY_OVERDUE_BODY),
+}
+
+
+@lru_cache(maxsize=1024)
+def format_due_date(epoch: float, fmt: str = EMAIL_DUE_DATE_FORMAT) -> str:
+    """Format a due date epoch for emails, cached since batches often share dates"""
+    due_date = datetime.fromtimestamp(epoch, tz=timezone.utc)
+    return due_date.strftime(fmt)
+
+
+def todo_view(
+    todo_doc: Mapping[str, Any], due_date_format: str = EMAIL_DUE_DATE_FORMAT
+) -> dict:
+    """Collect the template fields shared by every todo email"""
+    due_date_str = "Not specified"
+    due_date_epoch = todo_doc.get("due_date")
+    if due_date_epoch:
+        try:
+            due_date_str = format_due_date(float(due_date_epoch), due_date_format)
+        except (ValueError, TypeError, OverflowError, OSError):
+            logging.warning("Invalid due_date format for todo %s", todo_doc.get("id"))
+
+    return {
+        "assignee": todo_doc.get("assignee") or "User",
+        "title": todo_doc.get("title", "Untitled"),
+        "description": todo_doc.get("description") or "No description",
+        "due_date_str": due_date_str,
+        "status": todo_doc.get("status", "Pending"),
+    }
+
+
+def compose_reminder(kind: str, todo_doc: Mapping[str, Any]) -> Tuple[str, str]:
+    """Render the subject and body of a scheduled reminder email"""
+    subject_template, body_template = REMINDERS[kind]
+    view = todo_view(todo_doc, REMINDER_DUE_DATE_FORMAT)
+    return subject_template.format_map(view), body_template.format_map(view)
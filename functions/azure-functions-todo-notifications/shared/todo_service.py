@@ -1,10 +1,42 @@
 import logging
 import os
-from datetime import datetime, timedelta
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 
-import pytz
+from azure.core import MatchConditions
 from azure.cosmos import CosmosClient
-from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from azure.cosmos.exceptions import (
+    CosmosBatchOperationError,
+    CosmosResourceNotFoundError,
+)
+
+UTC = timezone.utc
+
+# Read once per worker process rather than on every TodoService construction
+COSMOS_DB_ENDPOINT = os.environ.get("COSMOS_DB_ENDPOINT")
+COSMOS_DB_KEY = os.environ.get("COSMOS_DB_KEY")
+
+# Partition key value the web app writes every todo item under
+DEFAULT_PARTITION_KEY = "family_todos"
+
+# Latest due date the scheduled notifier can act on: the end of the 24-hour
+# reminder slot. Overdue items keep getting daily reminders however late
+# they are, so there is no lower bound. In seconds, matching the epoch
+# timestamps stored on each item.
+ACTIONABLE_LOOKAHEAD = 25 * 3600
+
+# Cosmos DB limits a transactional batch to 100 operations
+MAX_BATCH_OPERATIONS = 100
+
+# Cosmos DB limits a single patch request to 10 operations
+MAX_PATCH_OPERATIONS = 10
+
+
+@lru_cache(maxsize=None)
+def get_cosmos_client(cosmos_endpoint, cosmos_key):
+    """Return a Cosmos client shared by every service using the same account"""
+    return CosmosClient(cosmos_endpoint, cosmos_key)
 
 
 class TodoService:
@@ -14,21 +46,36 @@ class TodoService:
         cosmos_key=None,
         database_name="familyleppanen",
         container_name="todos",
+        partition_key=DEFAULT_PARTITION_KEY,
     ):
         # Use environment variables if not provided
-        self.cosmos_endpoint = cosmos_endpoint or os.getenv("COSMOS_DB_ENDPOINT")
-        self.cosmos_key = cosmos_key or os.getenv("COSMOS_DB_KEY")
+        self.cosmos_endpoint = cosmos_endpoint or COSMOS_DB_ENDPOINT
+        self.cosmos_key = cosmos_key or COSMOS_DB_KEY
         self.database_name = database_name
         self.container_name = container_name
+        self.partition_key = partition_key
 
-        if not self.cosmos_endpoint or not self.cosmos_key:
-            raise ValueError("Cosmos DB endpoint and key must be provided")
+        missing = [
+            name
+            for name, value in (
+                ("COSMOS_DB_ENDPOINT", self.cosmos_endpoint),
+                ("COSMOS_DB_KEY", self.cosmos_key),
+            )
+            if not value
+        ]
+        if missing:
+            raise ValueError(
+                f"Missing required Cosmos DB settings: {', '.join(missing)}"
+            )
 
         # Initialize Cosmos client
-        self.client = CosmosClient(self.cosmos_endpoint, self.cosmos_key)
+        self.client = get_cosmos_client(self.cosmos_endpoint, self.cosmos_key)
         self.database = self.client.get_database_client(self.database_name)
         self.container = self.database.get_container_client(self.container_name)
 
+        # Field updates waiting to be flushed, by partition key and item ID
+        self._pending = defaultdict(dict)
+
     def upsert_item(self, todo):
         """Insert or update a todo item in Cosmos DB"""
         try:
@@ -37,7 +84,7 @@ class TodoService:
                 raise ValueError("Todo item must have an 'id' field")
 
             # Add metadata for tracking
-            current_time = datetime.now(pytz.utc)
+            current_time = datetime.now(UTC)
 
             # Set created_at if it's a new item (doesn't exist)
             if not todo.get("created_at"):
@@ -49,136 +96,232 @@ class TodoService:
             # Upsert the item in Cosmos DB
             result = self.container.upsert_item(body=todo)
 
-            logging.info(f"Successfully upserted todo item with ID: {todo['id']}")
+            logging.info("Successfully upserted todo item with ID: %s", todo["id"])
             return result
 
         except ValueError as ve:
-            logging.error(f"Validation error upserting todo: {str(ve)}")
+            logging.error("Validation error upserting todo: %s", ve)
             raise
         except Exception as e:
             logging.error(
-                f"Error upserting todo item {todo.get('id', 'unknown')}: {str(e)}"
+                "Error upserting todo item %s: %s", todo.get("id", "unknown"), e
             )
             raise
 
+    def patch_item(self, todo_id, partition_key, operations, etag=None):
+        """Apply patch operations to a todo item, optionally only if its etag matches"""
+        try:
+            if etag:
+                result = self.container.patch_item(
+                    item=todo_id,
+                    partition_key=partition_key,
+                    patch_operations=operations,
+                    etag=etag,
+                    match_condition=MatchConditions.IfNotModified,
+                )
+            else:
+                result = self.container.patch_item(
+                    item=todo_id,
+                    partition_key=partition_key,
+                    patch_operations=operations,
+                )
+            logging.info("Successfully patched todo item with ID: %s", todo_id)
+            return result
+        except Exception as e:
+            logging.error("Error patching todo item %s: %s", todo_id, e)
+            raise
+
+    def queue_update(self, todo_id, partition_key, fields):
+        """Queue field updates for a todo item until the next flush"""
+        # Updates to the same item are coalesced into a single patch
+        self._pending[partition_key].setdefault(todo_id, {}).update(fields)
+
+    def flush_batches(self):
+        """Write all queued updates as transactional batches per partition"""
+        pending, self._pending = self._pending, defaultdict(dict)
+
+        for partition_key, updates in pending.items():
+            operations = []
+            for todo_id, fields in updates.items():
+                patch_ops = [
+                    {"op": "set", "path": f"/{field}", "value": value}
+                    for field, value in fields.items()
+                ]
+                for start in range(0, len(patch_ops), MAX_PATCH_OPERATIONS):
+                    chunk = patch_ops[start : start + MAX_PATCH_OPERATIONS]
+                    operations.append(("patch", (todo_id, chunk)))
+
+            for start in range(0, len(operations), MAX_BATCH_OPERATIONS):
+                chunk = operations[start : start + MAX_BATCH_OPERATIONS]
+                try:
+                    self.container.execute_item_batch(
+                        batch_operations=chunk, partition_key=partition_key
+                    )
+                    logging.info(
+                        "Flushed %s patch operations for partition %s",
+                        len(chunk),
+                        partition_key,
+                    )
+                except CosmosBatchOperationError as e:
+                    # A batch is atomic, so retry item by item to keep the
+                    # updates that are still valid
+                    logging.warning(
+                        "Batch failed at operation %s, patching items individually",
+                        e.error_index,
+                    )
+                    self._patch_individually(chunk, partition_key)
+                except Exception as e:
+                    logging.error(
+                        "Error flushing batch for partition %s: %s", partition_key, e
+                    )
+
+    def _patch_individually(self, operations, partition_key):
+        for _, (todo_id, patch_ops) in operations:
+            try:
+                self.container.patch_item(
+                    item=todo_id,
+                    partition_key=partition_key,
+                    patch_operations=patch_ops,
+                )
+            except Exception as e:
+                logging.error("Error patching todo item %s: %s", todo_id, e)
+
     def get_assignee_email(self, todo_item):
         return todo_item.get("email", "")
 
     def is_due_soon(self, due_date):
         if isinstance(due_date, str):
             due_date = datetime.fromisoformat(due_date.replace("Z", "+00:00"))
-        return due_date <= datetime.now(pytz.utc) + timedelta(days=1)
+        return due_date <= datetime.now(UTC) + timedelta(days=1)
 
     def is_overdue(self, due_date):
         if isinstance(due_date, str):
             due_date = datetime.fromisoformat(due_date.replace("Z", "+00:00"))
-        return due_date < datetime.now(pytz.utc)
+        return due_date < datetime.now(UTC)
 
     def get_all_todos(self):
         """Retrieve all todo items from Cosmos DB"""
         try:
             query = "SELECT * FROM c"
-            items = list(
+            return list(
+                self.container.query_items(
+                    query=query, partition_key=self.partition_key
+                )
+            )
+        except Exception as e:
+            logging.error("Error retrieving todos: %s", e)
+            return []
+
+    def get_actionable_todos(self, now_epoch):
+        """Retrieve non-completed todos that are overdue or due within the lookahead"""
+        try:
+            query = """
+                SELECT * FROM c
+                WHERE c.status != 'Completed'
+                AND c.due_date <= @hi
+            """
+            parameters = [
+                {"name": "@hi", "value": now_epoch + ACTIONABLE_LOOKAHEAD},
+            ]
+            return list(
                 self.container.query_items(
-                    query=query, enable_cross_partition_query=True
+                    query=query,
+                    parameters=parameters,
+                    partition_key=self.partition_key,
                 )
             )
-            return items
         except Exception as e:
-            logging.error(f"Error retrieving todos: {str(e)}")
+            logging.error("Error retrieving actionable todos: %s", e)
             return []
 
     def get_todo_by_id(self, todo_id, partition_key=None):
         """Retrieve a specific todo item by ID"""
         try:
-            if partition_key:
-                item = self.container.read_item(
-                    item=todo_id, partition_key=partition_key
-                )
-            else:
-                # If no partition key provided, query for the item
-                query = f"SELECT * FROM c WHERE c.id = '{todo_id}'"
-                items = list(
-                    self.container.query_items(
-                        query=query, enable_cross_partition_query=True
-                    )
-                )
-                item = items[0] if items else None
+            # Point read, far cheaper than querying for the ID
+            item = self.container.read_item(
+                item=todo_id, partition_key=partition_key or self.partition_key
+            )
             return item
         except CosmosResourceNotFoundError:
-            logging.warning(f"Todo item with ID {todo_id} not found")
+            logging.warning("Todo item with ID %s not found", todo_id)
             return None
         except Exception as e:
-            logging.error(f"Error retrieving todo {todo_id}: {str(e)}")
+            logging.error("Error retrieving todo %s: %s", todo_id, e)
             return None
 
     def get_todos_by_status(self, status):
         """Retrieve todo items by status"""
         try:
-            query = f"SELECT * FROM c WHERE c.status = '{status}'"
-            items = list(
+            query = "SELECT * FROM c WHERE c.status = @status"
+            return list(
                 self.container.query_items(
-                    query=query, enable_cross_partition_query=True
+                    query=query,
+                    parameters=[{"name": "@status", "value": status}],
+                    partition_key=self.partition_key,
                 )
             )
-            return items
         except Exception as e:
-            logging.error(f"Error retrieving todos by status {status}: {str(e)}")
+            logging.error("Error retrieving todos by status %s: %s", status, e)
             return []
 
     def get_due_items(self):
         """Get overdue items that are not started"""
         try:
-            current_time = datetime.now(pytz.utc).isoformat()
-            query = f"""
-                SELECT * FROM c 
-                WHERE c.status = 'Not Started' 
-                AND c.due_date < '{current_time}'
+            current_time = int(datetime.now(UTC).timestamp())
+            query = """
+                SELECT * FROM c
+                WHERE c.status = 'Pending'
+                AND c.due_date < @now
             """
-            items = list(
+            return list(
                 self.container.query_items(
-                    query=query, enable_cross_partition_query=True
+                    query=query,
+                    parameters=[{"name": "@now", "value": current_time}],
+                    partition_key=self.partition_key,
                 )
             )
-            return items
         except Exception as e:
-            logging.error(f"Error retrieving due items: {str(e)}")
+            logging.error("Error retrieving due items: %s", e)
             return []
 
     def get_items_due_soon(self):
         """Get items due within the next 24 hours"""
         try:
-            current_time = datetime.now(pytz.utc)
+            current_time = datetime.now(UTC)
             future_time = current_time + timedelta(days=1)
 
-            query = f"""
-                SELECT * FROM c 
-                WHERE c.due_date >= '{current_time.isoformat()}' 
-                AND c.due_date <= '{future_time.isoformat()}'
+            query = """
+                SELECT * FROM c
+                WHERE c.due_date >= @now
+                AND c.due_date <= @future
                 AND c.status != 'Completed'
             """
-            items = list(
+            parameters = [
+                {"name": "@now", "value": int(current_time.timestamp())},
+                {"name": "@future", "value": int(future_time.timestamp())},
+            ]
+            return list(
                 self.container.query_items(
-                    query=query, enable_cross_partition_query=True
+                    query=query, parameters=parameters, partition_key=self.partition_key
                 )
             )
-            return items
         except Exception as e:
-            logging.error(f"Error retrieving items due soon: {str(e)}")
+            logging.error("Error retrieving items due soon: %s", e)
             return []
 
     def get_todos_by_assignee(self, email):
         """Get todos assigned to a specific email"""
         try:
-            query = f"SELECT * FROM c WHERE c.email = '{email}'"
-            items = list(
+            query = "SELECT * FROM c WHERE c.email = @email"
+            return list(
                 self.container.query_items(
-                    query=query, enable_cross_partition_query=True
+                    query=query,
+                    parameters=[{"name": "@email", "value": email}],
+                    partition_key=self.partition_key,
                 )
             )
-            return items
         except Exception as e:
-            logging.error(f"Error retrieving todos for assignee {email}: {str(e)}")
+            logging.error("Error retrieving todos for assignee %s: %s", email, e)
             return []
 
     def notify_assignee(self, todo_item):
@@ -200,3 +343,9 @@ class TodoService:
         due_soon_items = self.get_items_due_soon()
         for item in due_soon_items:
             self.notify_assignee(item)
+
+
+@lru_cache(maxsize=1)
+def get_todo_service() -> TodoService:
+    """Return the TodoService shared across invocations on this worker"""
+    return TodoService()
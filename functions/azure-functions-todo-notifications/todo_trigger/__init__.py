@@ -1,116 +1,208 @@
-import json
+import asyncio
 import logging
-import os
-from datetime import datetime, timezone
-from typing import Any, Dict
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, List, Mapping, Tuple
 
 import azure.functions as func
-from shared.email_service import send_email
-from shared.todo_service import TodoService
+from azure.core.exceptions import AzureError
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError
+from shared.email_service import get_async_session, send_email_batch_async
+from shared.notifications import CHANGE_NOTIFICATIONS, todo_view
+from shared.todo_service import DEFAULT_PARTITION_KEY, TodoService, get_todo_service
+
+# Fields written by the notification functions themselves
+_TRACKING_FIELDS = frozenset(
+    {
+        "new_todo_notification_sent",
+        "reminder_24h_sent",
+        "final_reminder_sent",
+        "last_notification_time",
+    }
+)
+
+# Fields edited by users through the web app
+_CONTENT_FIELDS = frozenset(
+    {"title", "description", "assignee", "email", "due_date", "priority", "status"}
+)
+
+# Notification kind -> queued (todo, email, template view) for this batch
+Outbox = Dict[str, List[Tuple[Mapping[str, Any], str, Dict[str, str]]]]
 
+# (id, _etag) of documents this function patched itself, so their change feed
+# echo can be skipped without guessing from timestamps
+_MAX_SELF_WRITES = 1024
+_recent_self_writes: "OrderedDict[tuple, None]" = OrderedDict()
+_self_writes_lock = threading.Lock()
 
-def main(documents: func.DocumentList) -> None:
+
+def _remember_self_write(todo_id: str, etag: str) -> None:
+    """Record a document version written by this function"""
+    with _self_writes_lock:
+        _recent_self_writes[(todo_id, etag)] = None
+        while len(_recent_self_writes) > _MAX_SELF_WRITES:
+            _recent_self_writes.popitem(last=False)
+
+
+async def main(documents: func.DocumentList) -> None:
     """
     Cosmos DB trigger that processes todo document changes
     and sends appropriate notifications.
     """
     if documents:
-        logging.info(f"Processing {len(documents)} todo document changes")
+        logging.info("Processing %s todo document changes", len(documents))
+
+        # Fail before sending anything if Cosmos DB is not configured
+        todo_service = get_todo_service()
+
+        # Every document in the batch is judged against the same timestamp
+        now_ts = int(time.time())
+
+        # Emails for the whole batch are collected and sent together
+        outbox: Outbox = defaultdict(list)
 
+        # func.Document is already a mapping, so it is processed as-is
+        # rather than round-tripped through JSON
         for document in documents:
+            # A failing document must not stop the rest of the batch
             try:
-                doc_dict = json.loads(document.to_json())
-                process_todo_change(doc_dict)
+                process_todo_change(document, outbox, now_ts)
             except Exception as e:
-                logging.error(f"Error processing document: {str(e)}")
-                continue
+                logging.error(
+                    "Error processing todo %s: %s", document.get("id", "unknown"), e
+                )
 
+        sent = await send_outbox(outbox) if outbox else []
 
-def process_todo_change(todo_doc: Dict[str, Any]) -> None:
-    """Process a single todo document change"""
-    try:
-        todo_id = todo_doc.get("id", "unknown")
-        logging.info(f"Processing todo change for ID: {todo_id}")
+        # Only new todos whose email actually went out are marked, so a failed
+        # send is retried when the todo next changes
+        new_todos = [todo_doc for kind, todo_doc in sent if kind == "new"]
+
+        # Cosmos DB calls are blocking, so run them off the event loop
+        results = await asyncio.gather(
+            *(
+                asyncio.to_thread(
+                    mark_new_todo_notification_sent, todo_doc, todo_service
+                )
+                for todo_doc in new_todos
+            ),
+            return_exceptions=True,
+        )
+
+        # The emails are already sent, so a failed mark must not fail the batch
+        for todo_doc, result in zip(new_todos, results):
+            if isinstance(result, Exception):
+                logging.error(
+                    "Error marking todo %s as notified: %s",
+                    todo_doc.get("id", "unknown"),
+                    result,
+                )
+
+
+async def send_outbox(outbox: Outbox) -> List[Tuple[str, Mapping[str, Any]]]:
+    """
+    Send the queued notification emails using Mailgun batch sending.
+    Returns (kind, todo) for every todo whose email was sent.
+    """
+    session = get_async_session()
+    kinds = list(outbox)
+    batches = await asyncio.gather(
+        *(
+            send_email_batch_async(
+                session,
+                *CHANGE_NOTIFICATIONS[kind],
+                [(email, view) for _, email, view in outbox[kind]],
+            )
+            for kind in kinds
+        ),
+        return_exceptions=True,
+    )
 
-        # Check if this is a system-generated update (should be ignored)
-        if is_system_update(todo_doc):
-            logging.info(f"Skipping system update for todo {todo_id}")
-            return
+    sent = []
+    for kind, results in zip(kinds, batches):
+        if isinstance(results, Exception):
+            logging.error(
+                "❌ Failed to send %s %s todo notifications: %s",
+                len(outbox[kind]),
+                kind,
+                results,
+            )
+            continue
+        for (todo_doc, _, _), result in zip(outbox[kind], results):
+            if result["status"] == "success":
+                sent.append((kind, todo_doc))
+                logging.info("✅ %s for todo %s", result["message"], todo_doc.get("id"))
+            else:
+                logging.error(
+                    "❌ %s for todo %s", result["message"], todo_doc.get("id")
+                )
+    return sent
 
-        # Check if this is a new todo (doesn't have notification tracking fields)
-        is_new_todo = is_new_todo_document(todo_doc)
 
-        # Check if this is a notification-only update (should be ignored)
-        is_notification_update = is_notification_field_update(todo_doc)
+def process_todo_change(
+    todo_doc: Mapping[str, Any], outbox: Outbox, now_ts: int
+) -> None:
+    """Process a single todo document change, queueing its notification"""
+    todo_id = todo_doc.get("id", "unknown")
+    logging.info("Processing todo change for ID: %s", todo_id)
 
-        if is_new_todo:
-            send_new_todo_notification(todo_doc)
-            # Mark immediately using synchronous approach
-            mark_new_todo_notification_sent(todo_doc)
-        elif not is_notification_update:
-            send_todo_update_notification(todo_doc)
+    # Check if this is a system-generated update (should be ignored)
+    if is_system_update(todo_doc):
+        logging.info("Skipping system update for todo %s", todo_id)
+        return
 
-    except Exception as e:
-        logging.error(f"Error in process_todo_change: {str(e)}")
+    # Check if this is a new todo (doesn't have notification tracking fields)
+    if is_new_todo_document(todo_doc, now_ts):
+        queue_notification("new", todo_doc, outbox)
+    else:
+        # Notification-only updates were already skipped by is_system_update
+        queue_notification("updated", todo_doc, outbox)
 
 
-def is_system_update(todo_doc: Dict[str, Any]) -> bool:
+def is_system_update(todo_doc: Mapping[str, Any]) -> bool:
     """
     Check if this is a system-generated update that should not trigger notifications.
     Uses improved detection logic for Azure Functions.
     """
-    # Check for notification tracking fields that indicate system updates
-    tracking_fields = [
-        "new_todo_notification_sent",
-        "reminder_24h_sent",
-        "final_reminder_sent",
-        "last_notification_time",
-    ]
+    # Versions patched by this instance are known exactly
+    if (todo_doc.get("id"), todo_doc.get("_etag")) in _recent_self_writes:
+        return True
 
-    # Count tracking fields present
-    tracking_count = sum(
-        1 for field in tracking_fields if todo_doc.get(field) is not None
-    )
+    # Count tracking and content fields in a single pass over the document
+    tracking_count = content_count = 0
+    notification_sent = False
+    created_at = updated_at = None
+    for key, value in todo_doc.items():
+        if value is None:
+            continue
+        if key in _TRACKING_FIELDS:
+            tracking_count += 1
+            if key == "new_todo_notification_sent" and value is True:
+                notification_sent = True
+        elif key in _CONTENT_FIELDS:
+            content_count += 1
+        elif key == "created_at":
+            created_at = value
+        elif key == "updated_at":
+            updated_at = value
 
     # If we have the new_todo_notification_sent field set to True,
     # this is likely the update we made to mark notification as sent
-    if todo_doc.get("new_todo_notification_sent") is True:
+    if notification_sent:
         # Check if this update happened very recently after creation
-        created_at = todo_doc.get("created_at")
-        updated_at = todo_doc.get("updated_at")
-
-        if created_at and updated_at:
-            try:
-                if isinstance(created_at, (int, float)) and isinstance(
-                    updated_at, (int, float)
-                ):
-                    created_time = datetime.fromtimestamp(created_at, tz=timezone.utc)
-                    updated_time = datetime.fromtimestamp(updated_at, tz=timezone.utc)
-
-                    # If updated within 30 seconds of creation and has notification flag,
-                    # this is our system update
-                    time_diff = (updated_time - created_time).total_seconds()
-                    if 0 < time_diff < 30:
-                        logging.info(
-                            f"Detected system update (notification marking) for todo {todo_doc.get('id')}"
-                        )
-                        return True
-            except (ValueError, TypeError) as e:
-                logging.warning(f"Error parsing timestamps: {str(e)}")
-
-    # Additional check: if document has multiple tracking fields but few content fields
-    content_fields = [
-        "title",
-        "description",
-        "assignee",
-        "email",
-        "due_date",
-        "priority",
-        "status",
-    ]
-    content_count = sum(
-        1 for field in content_fields if todo_doc.get(field) is not None
-    )
+        if isinstance(created_at, (int, float)) and isinstance(
+            updated_at, (int, float)
+        ):
+            # If updated within 30 seconds of creation and has notification flag,
+            # this is our system update
+            time_diff = updated_at - created_at
+            if 0 < time_diff < 30:
+                logging.info(
+                    "Detected system update (notification marking) for todo %s",
+                    todo_doc.get("id"),
+                )
+                return True
 
     # If we have more tracking fields than content, likely a system update
     if tracking_count > 0 and content_count < 3:
@@ -119,7 +211,7 @@ def is_system_update(todo_doc: Dict[str, Any]) -> bool:
     return False
 
 
-def is_new_todo_document(todo_doc: Dict[str, Any]) -> bool:
+def is_new_todo_document(todo_doc: Mapping[str, Any], now_ts: int) -> bool:
     """
     Determine if this is a new todo by checking notification tracking fields
     """
@@ -127,18 +219,11 @@ def is_new_todo_document(todo_doc: Dict[str, Any]) -> bool:
     if todo_doc.get("new_todo_notification_sent") is True:
         return False
 
-    # Check if this appears to be a genuinely new todo
-    notification_fields = [
-        "reminder_24h_sent",
-        "final_reminder_sent",
-        "last_notification_time",
-        "new_todo_notification_sent",
-    ]
-
-    # If any notification field is set, it's not a new todo
+    # If any notification field is set, it's not a new todo; only the tracking
+    # fields actually present on the document are probed
     has_notification_fields = any(
-        todo_doc.get(field) is not None and todo_doc.get(field) is not False
-        for field in notification_fields
+        (value := todo_doc[field]) is not None and value is not False
+        for field in todo_doc.keys() & _TRACKING_FIELDS
     )
 
     if has_notification_fields:
@@ -146,176 +231,76 @@ def is_new_todo_document(todo_doc: Dict[str, Any]) -> bool:
 
     # Additional validation: check if recently created
     created_at = todo_doc.get("created_at")
-    if created_at:
-        try:
-            if isinstance(created_at, (int, float)):
-                created_time = datetime.fromtimestamp(created_at, tz=timezone.utc)
-                current_time = datetime.now(timezone.utc)
-                time_since_creation = (current_time - created_time).total_seconds()
-
-                # If created within last 60 seconds, it's likely a new todo
-                if time_since_creation < 60:
-                    logging.info(
-                        f"Detected new todo created {time_since_creation:.1f} seconds ago: {todo_doc.get('id')}"
-                    )
-                    return True
-        except (ValueError, TypeError) as e:
-            logging.warning(f"Error parsing created_at timestamp: {str(e)}")
-
-    # Default to not new if we can't determine
-    return False
+    if created_at and isinstance(created_at, (int, float)):
+        time_since_creation = now_ts - created_at
 
+        # If created within last 60 seconds, it's likely a new todo
+        if time_since_creation < 60:
+            logging.info(
+                "Detected new todo created %.1f seconds ago: %s",
+                time_since_creation,
+                todo_doc.get("id"),
+            )
+            return True
 
-def is_notification_field_update(todo_doc: Dict[str, Any]) -> bool:
-    """
-    Check if this update only involves notification tracking fields
-    """
-    # This is handled by is_system_update now for better accuracy
+    # Default to not new if we can't determine
     return False
 
 
-def send_new_todo_notification(todo_doc: Dict[str, Any]) -> None:
-    """Send notification for a newly created todo"""
-    try:
-        email = todo_doc.get("email")
-        assignee = todo_doc.get("assignee") or "User"
-        title = todo_doc.get("title", "Untitled")
-
-        if not email:
-            logging.warning(f"No email found for new todo {todo_doc.get('id')}")
-            return
-
-        # Format due date if available
-        due_date_str = "Not specified"
-        due_date_epoch = todo_doc.get("due_date")
-        if due_date_epoch:
-            try:
-                if isinstance(due_date_epoch, str):
-                    due_date_epoch = float(due_date_epoch)
-                due_date = datetime.fromtimestamp(due_date_epoch, tz=timezone.utc)
-                due_date_str = due_date.strftime("%A, %B %d, %Y at %I:%M %p UTC")
-            except (ValueError, TypeError):
-                logging.warning(
-                    f"Invalid due_date format for todo {todo_doc.get('id')}"
-                )
+def queue_notification(kind: str, todo_doc: Mapping[str, Any], outbox: Outbox) -> None:
+    """Queue the "new" or "updated" notification for a todo"""
+    todo_id = todo_doc.get("id")
+    email = todo_doc.get("email")
+    if not email:
+        logging.warning("No email found for %s todo %s", kind, todo_id)
+        return
 
-        subject = f"New Todo Assigned: {title}"
-        body = f"""Hello {assignee},
+    outbox[kind].append((todo_doc, email, todo_view(todo_doc)))
+    logging.info("Queued %s todo notification to %s for todo %s", kind, email, todo_id)
 
-A new todo item has been assigned to you:
 
-📋 Title: {title}
-📝 Description: {todo_doc.get('description', 'No description')}
-📅 Due Date: {due_date_str}
-
-Please review and plan accordingly.
-
-Best regards,
-Family Leppänen Todo System"""
-
-        send_email(email, subject, body)
-        logging.info(
-            f"✅ Sent new todo notification to {email} for todo {todo_doc.get('id')}"
-        )
-
-    except Exception as e:
-        logging.error(f"❌ Failed to send new todo notification: {str(e)}")
-
-
-def send_todo_update_notification(todo_doc: Dict[str, Any]) -> None:
-    """Send notification for todo updates (excluding notification field updates)"""
-    try:
-        email = todo_doc.get("email")
-        assignee = todo_doc.get("assignee") or "User"
-        title = todo_doc.get("title", "Untitled")
-
-        if not email:
-            logging.warning(f"No email found for updated todo {todo_doc.get('id')}")
-            return
-
-        # Format due date if available
-        due_date_str = "Not specified"
-        due_date_epoch = todo_doc.get("due_date")
-        if due_date_epoch:
-            try:
-                if isinstance(due_date_epoch, str):
-                    due_date_epoch = float(due_date_epoch)
-                due_date = datetime.fromtimestamp(due_date_epoch, tz=timezone.utc)
-                due_date_str = due_date.strftime("%A, %B %d, %Y at %I:%M %p UTC")
-            except (ValueError, TypeError):
-                logging.warning(
-                    f"Invalid due_date format for todo {todo_doc.get('id')}"
-                )
-
-        subject = f"Todo Updated: {title}"
-        body = f"""Hello {assignee},
-
-Your todo item has been updated:
-
-📋 Title: {title}
-📝 Description: {todo_doc.get('description', 'No description')}
-📅 Due Date: {due_date_str}
-✅ Status: {todo_doc.get('status', 'Pending')}
-
-Please review the changes.
-
-Best regards,
-Family Leppänen Todo System"""
-
-        send_email(email, subject, body)
-        logging.info(
-            f"✅ Sent todo update notification to {email} for todo {todo_doc.get('id')}"
-        )
-
-    except Exception as e:
-        logging.error(f"❌ Failed to send todo update notification: {str(e)}")
-
-
-def mark_new_todo_notification_sent(todo_doc: Dict[str, Any]) -> None:
+def mark_new_todo_notification_sent(
+    todo_doc: Mapping[str, Any], todo_service: TodoService
+) -> None:
     """
     Mark that new todo notification has been sent.
     Uses synchronous approach suitable for Azure Functions.
     """
-    try:
-        todo_service = TodoService()
-        todo_id = todo_doc.get("id")
-
-        if not todo_id:
-            logging.error("Cannot mark notification sent - no todo ID found")
-            return
+    todo_id = todo_doc.get("id")
+    if not todo_id:
+        logging.error("Cannot mark notification sent - no todo ID found")
+        return
+
+    partition_key = todo_doc.get("partition_key", DEFAULT_PARTITION_KEY)
+    operations = [
+        {"op": "set", "path": "/new_todo_notification_sent", "value": True},
+        {"op": "set", "path": "/updated_at", "value": int(time.time())},
+    ]
 
-        # Get the current document from Cosmos DB to ensure we have latest version
+    try:
+        # Patch only the tracking fields, guarded by the etag from the change feed
         try:
-            current_doc = todo_service.get_todo_by_id(
-                todo_id, partition_key="family_todos"
+            result = todo_service.patch_item(
+                todo_id, partition_key, operations, etag=todo_doc.get("_etag")
             )
-            if not current_doc:
-                logging.error(f"Could not retrieve todo {todo_id} from database")
-                return
-        except Exception as e:
-            logging.error(f"Error retrieving todo {todo_id}: {str(e)}")
-            # Fallback to using the provided document
-            current_doc = todo_doc.copy()
-
-        # Set the notification flag
-        current_doc["new_todo_notification_sent"] = True
-
-        # Update the updated_at timestamp
-        current_doc["updated_at"] = int(datetime.now(timezone.utc).timestamp())
-
-        # Update in Cosmos DB
-        result = todo_service.upsert_item(current_doc)
-
-        if result:
-            logging.info(
-                f"✅ Successfully marked new todo notification as sent for todo {todo_id}"
+        except CosmosAccessConditionFailedError:
+            # The todo changed after this change feed batch was read; the
+            # flag still applies, so set it on the latest version
+            logging.warning(
+                "Todo %s changed since notification, patching latest version", todo_id
             )
-        else:
-            logging.error(f"❌ Failed to update todo {todo_id} in database")
+            result = todo_service.patch_item(todo_id, partition_key, operations)
 
-    except Exception as e:
-        logging.error(f"❌ Failed to mark new todo notification as sent: {str(e)}")
+    except AzureError as e:
         # Log the full exception for debugging
-        import traceback
+        logging.exception("❌ Failed to mark new todo notification as sent: %s", e)
+        return
 
-        logging.error(f"Full traceback: {traceback.format_exc()}")
+    if result:
+        if result.get("_etag"):
+            _remember_self_write(todo_id, result["_etag"])
+        logging.info(
+            "✅ Successfully marked new todo notification as sent for todo %s", todo_id
+        )
+    else:
+        logging.error("❌ Failed to update todo %s in database", todo_id)